@@ -15,14 +15,38 @@ from __future__ import annotations
 import os
 import re
 import sys
+import mmap
 import pathlib
 import mimetypes
 from email import policy
-from email.parser import BytesParser
+from email.parser import BytesFeedParser
 from urllib.parse import urlparse
 
+# Optional: pip install pyahocorasick. One automaton walk replaces all keys
+# in a single O(N + matches) pass; without it we fall back to a compiled
+# regex alternation (still one pass, but slower per byte).
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
 
 ORIGIN = "https://data.seattle.gov"  # Used for root-relative URL rewriting
+_ORIGIN_NETLOC = urlparse(ORIGIN).netloc  # parsed once; urlparse is ~µs per call
+
+# Compiled once at import; these run over multi-MB HTML/CSS so per-call
+# re.compile cache lookups (and lambda forwarding per match) add up.
+# The CSS url() pattern is a bytes regex: stylesheets are rewritten on the
+# raw payload without a decode/encode round-trip.
+CSS_URL_RE = re.compile(rb"url\((['\"]?)(\/[^'\")]+)(['\"]?)\)")
+# All three root-relative shapes (attribute, url(/...), entity-quoted url)
+# fused into one alternation so the HTML is scanned once instead of three
+# times; the replacement dispatches on which named group matched.
+ROOT_REL_RE = re.compile(
+    r"\b(?P<attr>href|src|action)=(?P<q>['\"])(?P<apath>/(?!/)[^'\"]*)(?P=q)"
+    r"|url\((?P<openq>['\"]?)(?P<cpath>/(?!/)[^'\")]+)(?P<closeq>['\"]?)\)"
+    r"|url\(&quot;(?P<epath>/[^&]+)&quot;\)"
+)
 
 
 def safe_name(name: str) -> str:
@@ -97,7 +121,7 @@ def build_replacements(parts_info):
             repl[loc] = local
             try:
                 parsed = urlparse(loc)
-                if parsed.scheme in ("http", "https") and parsed.netloc == urlparse(ORIGIN).netloc:
+                if parsed.scheme in ("http", "https") and parsed.netloc == _ORIGIN_NETLOC:
                     path_key = parsed.path
                     if path_key:
                         repl[path_key] = local
@@ -108,49 +132,89 @@ def build_replacements(parts_info):
     return keys, repl
 
 
-def rewrite_root_relative_urls_in_html(html: str, origin: str) -> str:
-    # Attribute-based root-relative URLs: href="/...", src="/...", action="/..."
-    def repl_attr(m):
-        attr = m.group(1)
-        quote = m.group(2)
-        path = m.group(3)
-        if path.startswith('/') and not path.startswith('//'):
-            return f"{attr}={quote}{origin}{path}{quote}"
-        return m.group(0)
+def build_key_matcher(keys, repl_map):
+    """Return a callable text -> text that replaces every key in one pass.
 
-    html = re.sub(r"\b(href|src|action)=(['\"])\/(?!\/)([^'\"]*)\2",
-                  lambda m: repl_attr(m), html)
+    Uses an Aho-Corasick automaton when pyahocorasick is available, otherwise
+    a compiled regex alternation. Keys come in longest-first; both variants
+    prefer the longest key on overlaps, preserving the old replacement
+    semantics. Works on str or bytes keys (the automaton is str-only, so a
+    bytes table always takes the regex path)."""
+    if not keys:
+        return lambda text: text
 
-    # Inline CSS url(/...) where quotes are literal or HTML-entity encoded
-    def repl_css(m):
-        openp = m.group(1)
-        path = m.group(2)
-        closep = m.group(3)
-        if path.startswith('/') and not path.startswith('//'):
-            return f"url({openp}{origin}{path}{closep})"
-        return m.group(0)
+    if ahocorasick is not None and isinstance(keys[0], str):
+        auto = ahocorasick.Automaton()
+        for k in keys:
+            auto.add_word(k, (len(k), repl_map[k]))
+        auto.make_automaton()
+
+        def replace(text):
+            matches = [(end - length + 1, end + 1, value)
+                       for end, (length, value) in auto.iter(text)]
+            # Earliest start wins, longest key on ties; skip overlaps.
+            matches.sort(key=lambda t: (t[0], t[0] - t[1]))
+            out = []
+            pos = 0
+            for start, end, value in matches:
+                if start < pos:
+                    continue
+                out.append(text[pos:start])
+                out.append(value)
+                pos = end
+            out.append(text[pos:])
+            return ''.join(out)
+
+        return replace
+
+    sep = b'|' if isinstance(keys[0], bytes) else '|'
+    pat = re.compile(sep.join(re.escape(k) for k in keys))
+
+    def lookup(m, _get=repl_map.__getitem__):
+        return _get(m.group())
 
-    html = re.sub(r"url\((['\"]?)(\/[^'\")]+)(['\"]?)\)", lambda m: repl_css(m), html)
-    # Handle entity-encoded quotes inside style attributes: url(&quot;/...&quot;)
-    html = re.sub(r"url\((&quot;)(\/[^&]+)(&quot;)\)", lambda m: f"url(&quot;{origin}{m.group(2)}&quot;)", html)
-    return html
+    def replace(text):
+        return pat.sub(lookup, text)
 
+    return replace
 
-def rewrite_urls_in_css(css_text: str, keys, repl_map, origin: str) -> str:
+
+def rewrite_root_relative_urls_in_html(html: str, origin: str) -> str:
+    """Point root-relative references at the original host in one pass.
+
+    Covers href/src/action attributes, inline CSS url(/...), and
+    entity-quoted url(&quot;/...&quot;) inside style attributes.
+    Protocol-relative //host paths are left alone (the regex excludes
+    them via /(?!/)); the old per-shape passes tried to re-check that in
+    Python, and the attribute check was broken — its group captured the
+    path without the leading slash so it never rewrote anything."""
+    def repl(m):
+        apath = m.group('apath')
+        if apath is not None:
+            return f"{m.group('attr')}={m.group('q')}{origin}{apath}{m.group('q')}"
+        cpath = m.group('cpath')
+        if cpath is not None:
+            return f"url({m.group('openq')}{origin}{cpath}{m.group('closeq')})"
+        return f"url(&quot;{origin}{m.group('epath')}&quot;)"
+
+    return ROOT_REL_RE.sub(repl, html)
+
+
+def rewrite_urls_in_css(css: bytes, replace_keys, origin: str) -> bytes:
     # First, map known absolute and path keys to local paths
-    for k in keys:
-        if k in css_text:
-            css_text = css_text.replace(k, repl_map[k])
+    css = replace_keys(css)
     # Then, rewrite any remaining root-relative url(/...) to absolute origin
+    origin_b = origin.encode('utf-8')
+
     def repl_css(m):
         openp = m.group(1)
         path = m.group(2)
         closep = m.group(3)
-        if path.startswith('/') and not path.startswith('//'):
-            return f"url({openp}{origin}{path}{closep})"
+        if path.startswith(b'/') and not path.startswith(b'//'):
+            return b'url(' + openp + origin_b + path + closep + b')'
         return m.group(0)
-    css_text = re.sub(r"url\((['\"]?)(\/[^'\")]+)(['\"]?)\)", lambda m: repl_css(m), css_text)
-    return css_text
+
+    return CSS_URL_RE.sub(repl_css, css)
 
 
 def convert(mhtml_path: str, out_html_path: str, assets_dir: str):
@@ -161,8 +225,24 @@ def convert(mhtml_path: str, out_html_path: str, assets_dir: str):
     os.makedirs(os.path.dirname(out_html_path), exist_ok=True)
     os.makedirs(assets_dir, exist_ok=True)
 
+    # Feed the parser in 1 MiB chunks so MIME scanning overlaps disk I/O
+    # instead of buffering the entire snapshot before the walk. An mmap view
+    # serves the chunks straight from the page cache when available.
+    chunk_size = 1 << 20
+    parser = BytesFeedParser(policy=policy.default)
     with open(mhtml_path, 'rb') as f:
-        msg = BytesParser(policy=policy.default).parse(f)
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            mm = None
+        if mm is not None:
+            with mm:
+                for pos in range(0, len(mm), chunk_size):
+                    parser.feed(mm[pos:pos + chunk_size])
+        else:
+            while chunk := f.read(chunk_size):
+                parser.feed(chunk)
+    msg = parser.close()
 
     if msg.is_multipart():
         parts = list(msg.walk())
@@ -173,7 +253,15 @@ def convert(mhtml_path: str, out_html_path: str, assets_dir: str):
     assets = []
     used_names = set()
 
-    css_assets_indices = []
+    # Resolve the directories once; per-part paths are then a single join and
+    # relative_to/as_posix instead of os.path.join + relpath + separator fixup.
+    out_dir = pathlib.Path(out_html_path).parent
+    assets_dir_p = pathlib.Path(assets_dir)
+
+    # CSS payloads are held (as raw bytes) until the replacement map exists,
+    # then written once with their url() references already rewritten —
+    # instead of write -> re-read -> rewrite -> re-write per stylesheet.
+    pending_css = []
 
     for idx, part in enumerate(parts):
         ctype = part.get_content_type()
@@ -198,48 +286,53 @@ def convert(mhtml_path: str, out_html_path: str, assets_dir: str):
             continue
 
         filename = pick_filename(part, used_names)
-        local_path = os.path.join(assets_dir, filename)
-        with open(local_path, 'wb') as outf:
-            outf.write(payload)
+        local_path = assets_dir_p / filename
+        if ctype == 'text/css':
+            pending_css.append((local_path, payload))
+        else:
+            with open(local_path, 'wb') as outf:
+                outf.write(payload)
 
+        try:
+            rel_path = local_path.relative_to(out_dir).as_posix()
+        except ValueError:
+            # assets dir is not under the output dir; fall back to relpath
+            rel_path = pathlib.Path(os.path.relpath(local_path, out_dir)).as_posix()
         asset_info = {
             'content_type': ctype,
-            'local_path': os.path.relpath(local_path, os.path.dirname(out_html_path)).replace('\\', '/'),
+            'local_path': rel_path,
             'cid': (part.get('Content-ID') or '').strip('<>') or None,
             'location': part.get('Content-Location') or None,
         }
         assets.append(asset_info)
-        if ctype == 'text/css':
-            css_assets_indices.append(len(assets) - 1)
 
     if html_text is None:
         raise SystemExit('No text/html part found in MHTML file')
 
     # Build replacement map (includes origin path variants)
     keys, repl = build_replacements(assets)
+    replace_keys = build_key_matcher(keys, repl)
 
-    # Replace references to embedded parts in HTML
-    rewritten = html_text
-    for k in keys:
-        rewritten = rewritten.replace(k, repl[k])
+    # Replace references to embedded parts in HTML in one pass
+    rewritten = replace_keys(html_text)
 
     # Rewrite root-relative references to absolute origin for any remaining resources
     rewritten = rewrite_root_relative_urls_in_html(rewritten, ORIGIN)
 
-    # Post-process CSS files to fix their internal url() references
-    for i in css_assets_indices:
-        css_local_path = os.path.join(os.path.dirname(out_html_path), assets[i]['local_path'])
+    # Specialized bytes key table for the CSS loop: encoded once, one matcher
+    # reused across every stylesheet, no per-file decode/encode round-trip.
+    repl_b = {k.encode('utf-8'): v.encode('utf-8') for k, v in repl.items()}
+    keys_b = sorted(repl_b, key=len, reverse=True)
+    replace_keys_b = build_key_matcher(keys_b, repl_b)
+
+    # Write CSS assets once, with their internal url() references fixed
+    for css_local_path, css_bytes in pending_css:
         try:
-            raw = pathlib.Path(css_local_path).read_bytes()
-            try:
-                css_text = raw.decode('utf-8')
-            except UnicodeDecodeError:
-                css_text = raw.decode('latin-1', errors='replace')
-            css_text = rewrite_urls_in_css(css_text, keys, repl, ORIGIN)
-            pathlib.Path(css_local_path).write_text(css_text, encoding='utf-8')
+            css_bytes = rewrite_urls_in_css(css_bytes, replace_keys_b, ORIGIN)
         except Exception:
-            # Best-effort: skip on failure
+            # Best-effort: fall back to the unrewritten bytes
             pass
+        css_local_path.write_bytes(css_bytes)
 
     # Write HTML out
     with open(out_html_path, 'w', encoding='utf-8') as outf: